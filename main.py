@@ -3,13 +3,22 @@ import pydantic
 import shapefile
 import zipfile
 import io
+import json
+import re
+import collections
 import os
 import tempfile
 import shutil
 import logging
+import struct
+import mmap
+import gc
+from decimal import Decimal
 import fiona
 import ijson
-from decimal import Decimal
+import orjson
+import zstandard
+import brotli
 from fiona.crs import from_epsg
 from fastapi import BackgroundTasks, UploadFile, File, Form
 from fastapi.responses import StreamingResponse, FileResponse
@@ -36,8 +45,113 @@ WGS84_PRJ = 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",' \
             'SPHEROID["WGS_1984",6378137,298.257223563]],' \
             'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]'
 
+# Multi-part types that are flattened into one feature per part
+FLATTENED_TYPES = {
+    "MultiPolygon": "Polygon",
+    "MultiLineString": "LineString",
+}
+
+SHAPETYPE_MAP = {
+    "Point": shapefile.POINT,
+    "MultiPoint": shapefile.MULTIPOINT,
+    "LineString": shapefile.POLYLINE,
+    "MultiLineString": shapefile.POLYLINE, # Flattened
+    "Polygon": shapefile.POLYGON,
+    "MultiPolygon": shapefile.POLYGON, # Flattened
+}
+
+# Inferred property type -> pyshp field (type, size, decimal); anything else is stored as text
+SHP_FIELD_SPECS = {
+    int: ('N', 50, 0),
+    float: ('F', 18, 10),
+    str: ('C', 254, 0),
+}
+
+# Inferred property type -> Fiona field type for GPKG output
+GPKG_FIELD_TYPES = {
+    str: 'str',
+    int: 'int',
+    float: 'float',
+    bool: 'int'
+}
+
+# Range of a GPKG (64-bit) integer field; ints of up to 18 characters always fit
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+INT64_SAFE_WIDTH = 18
+
+# Copy size when feeding shapefile components to zlib: fewer, larger deflate calls
+ZIP_CHUNK_SIZE = 256 * 1024
+
+# In-memory size of each shapefile component before it spills to disk
+SHAPEFILE_SPOOL_SIZE = 16 * 1024 * 1024
+
+# GDAL config for GPKG writes: the output is a throwaway temp file, so skip fsync,
+# on-disk journaling and the foreign key check on open
+GPKG_WRITE_OPTIONS = {
+    'OGR_SQLITE_SYNCHRONOUS': 'OFF',
+    'OGR_SQLITE_JOURNAL': 'MEMORY',
+    'OGR_GPKG_FOREIGN_KEY_CHECK': 'NO',
+}
+
+# .shp/.shx layout: 100-byte file header, then big-endian (number, length) record headers
+SHP_HEADER_SIZE = 100
+SHP_RECORD_HEADER = struct.Struct('>2i')
+SHP_POINT_RECORD = struct.Struct('<i2d')
+SHP_BOX_HEADER = struct.Struct('<i4d')
+
+MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+
+# Upload copy size: a 50MB upload takes 50 awaited reads instead of ~6400
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Uploads up to this size are decoded in one orjson call and kept in memory;
+# larger ones are streamed with ijson and spooled to NDJSON
+IN_MEMORY_PARSE_LIMIT = 16 * 1024 * 1024
+
+# Integers orjson decodes as floats (beyond 64 bits) have at least this many digits;
+# uploads holding such a run take the exact streaming path
+WIDE_INT_DIGITS = 19
+DIGIT_FOLD = bytes.maketrans(b'123456789', b'000000000')
+
+# Negotiated transport encodings for shapefile downloads, in order of preference.
+# zstd level 3 / brotli quality 4 are fast real-time tiers.
+TRANSPORT_ENCODINGS = ('zstd', 'br')
+ZSTD_LEVEL = 3
+BROTLI_QUALITY = 4
+
+# GeoJSON Text Sequences (RFC 8142): one feature per line, optionally RS-prefixed
+GEOJSON_SEQ_MEDIA_TYPE = 'application/geo+json-seq'
+GEOJSON_SEQ_SNIFF = re.compile(rb'\x1e|\{[ \t]*"type"[ \t]*:[ \t]*"Feature"[ \t]*[,}]')
+
+# Leads spool lines written by the stdlib encoder, which orjson would not decode exactly
+SPOOL_STDLIB_MARK = 0x1e
+
+# Leading bytes of an upload inspected before it is parsed
+HEAD_SNIFF_SIZE = 4096
+
+# Bytes allowed before a FeatureCollection's opening brace
+JSON_LEADING_BYTES = b' \t\r\n\xef\xbb\xbf'
+
+# Output name: safe for paths and the Content-Disposition header, no ".." traversal
+NAME_PATTERN = re.compile(r'(?!.*\.\.)[A-Za-z0-9_\-. ]{1,128}')
+
 logging.basicConfig(level=logging.INFO)
 
+def load_ijson_backend():
+    """
+    Returns the fastest available ijson backend, preferring the yajl2 C extension.
+    The pure-Python parser is an order of magnitude slower on large inputs.
+    """
+    for backend_name in ('yajl2_c', 'yajl2_cffi', 'yajl2'):
+        try:
+            return ijson.get_backend(backend_name)
+        except ImportError:
+            continue
+    logging.warning("No compiled ijson backend available, falling back to the pure-Python parser.")
+    return ijson.get_backend('python')
+
+ijson_backend = load_ijson_backend()
+
 def cleanup_temp_dir(temp_dir_path: str):
     try:
         shutil.rmtree(temp_dir_path)
@@ -45,265 +159,675 @@ def cleanup_temp_dir(temp_dir_path: str):
     except Exception as e:
         logging.error(f"Error cleaning up temp directory {temp_dir_path}: {e}")
 
-def infer_schema_streaming(input_path: str):
+def advise_sequential(f):
+    """
+    Hints the kernel that f will be read once front to back, so it reads
+    ahead aggressively and can drop pages behind the reader.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+def negotiate_transport_encoding(accept_encoding: str):
+    """
+    Returns the preferred encoding in TRANSPORT_ENCODINGS that the
+    Accept-Encoding header allows, or None. q=0 or an unparsable q rejects a
+    coding, and * only stands for codings that are not rejected by name.
+    """
+    accepted = set()
+    rejected = set()
+    wildcard = False
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        acceptable = True
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    acceptable = float(value) > 0
+                except ValueError:
+                    acceptable = False
+                break
+        if acceptable:
+            if coding == '*':
+                wildcard = True
+            else:
+                accepted.add(coding)
+        else:
+            rejected.add(coding)
+            accepted.discard(coding)
+    for encoding in TRANSPORT_ENCODINGS:
+        if encoding in accepted or (wildcard and encoding not in rejected):
+            return encoding
+    return None
+
+def infer_schema(features):
     """
-    First pass: Stream through the file to infer schema from all features.
-    Returns (properties_schema, first_geometry_type)
+    Infers the output schema from an iterable of GeoJSON features.
+    Returns (properties_schema, first_geometry_type, text_widths, wide_int_keys),
+    where text_widths holds the longest encoded text form seen for each property
+    and wide_int_keys the properties holding an int outside the 64-bit range.
     """
     properties_schema = {}
+    text_widths = {}
+    wide_int_keys = set()
     first_geom_type = None
+    # Bound methods hoisted out of the per-property loop
+    get_type = properties_schema.get
+    get_width = text_widths.get
     
+    for feature in features:
+        # Capture first geometry type
+        if first_geom_type is None:
+            geom = feature.get('geometry')
+            if geom and geom.get('type'):
+                first_geom_type = geom.get('type')
+        
+        props = feature.get('properties')
+        if not props:
+            continue
+        for key, value in props.items():
+            if value is None:
+                continue
+            
+            # Track the widest value so text fields can be sized to fit
+            val_type = type(value)
+            if val_type is str:
+                width = len(value.encode('utf-8'))
+            else:
+                width = len(str(value))
+                # Only this wide an int can leave the 64-bit range, so narrower values skip the bounds check
+                if width > INT64_SAFE_WIDTH and val_type is int and not INT64_MIN <= value <= INT64_MAX:
+                    wide_int_keys.add(key)
+            if width > get_width(key, 0):
+                text_widths[key] = width
+            
+            # Normalize type
+            if val_type is bool:
+                val_type = int
+            
+            current_type = get_type(key)
+            
+            # str is terminal: once a key is promoted no later value can change it
+            if current_type is val_type or current_type is str:
+                continue
+            elif current_type is None:
+                properties_schema[key] = val_type
+            elif (current_type is int and val_type is float) or (current_type is float and val_type is int):
+                properties_schema[key] = float
+            else:
+                properties_schema[key] = str
+    
+    return properties_schema, first_geom_type, text_widths, wide_int_keys
+
+def spool_features(features, spool):
+    """
+    Generator that passes features through while writing each one to spool
+    as a line of newline-delimited JSON.
+    """
+    for feature in features:
+        try:
+            spool.write(orjson.dumps(feature))
+        except TypeError:
+            # orjson rejects integers beyond 64 bits; the stdlib encoder does not
+            spool.write(bytes((SPOOL_STDLIB_MARK,)))
+            spool.write(json.dumps(feature).encode('utf-8'))
+        spool.write(b"\n")
+        yield feature
+
+def iter_spooled_features(spool_path: str):
+    """
+    Generator that reads back features written by spool_features.
+    """
+    with open(spool_path, 'rb') as spool:
+        advise_sequential(spool)
+        for line in spool:
+            if line[0] == SPOOL_STDLIB_MARK:
+                # orjson would turn the wide integers in this line into floats
+                yield json.loads(line[1:])
+            else:
+                yield orjson.loads(line)
+
+def decimals_to_float(value):
+    """
+    Returns value with every Decimal ijson produced, at any depth, converted to float.
+    """
+    val_type = type(value)
+    if val_type is Decimal:
+        return float(value)
+    if val_type is dict:
+        return {k: decimals_to_float(v) for k, v in value.items()}
+    if val_type is list:
+        return [decimals_to_float(v) for v in value]
+    return value
+
+def spool_and_infer(input_path: str, spool_path: str, use_float: bool):
+    """
+    Streams features with ijson into infer_schema while spooling them to
+    NDJSON. Without use_float, ijson's Decimals are converted to float.
+    """
+    with open(input_path, 'rb') as f, open(spool_path, 'wb') as spool:
+        advise_sequential(f)
+        # ijson_backend.items yields objects from the stream. 
+        # We assume standard GeoJSON structure: root -> features -> item
+        features = ijson_backend.items(f, 'features.item', use_float=use_float)
+        if not use_float:
+            features = map(decimals_to_float, features)
+        return infer_schema(spool_features(features, spool))
+
+def infer_schema_streaming(input_path: str, spool_path: str):
+    """
+    Single parse of the input: stream features with ijson to infer the
+    schema while spooling them to NDJSON, so the write pass only has to
+    decode flat lines instead of walking the GeoJSON tree again.
+    Returns the same tuple as infer_schema.
+    """
     try:
-        with open(input_path, 'rb') as f:
-            # ijson.items yields objects from the stream. 
-            # We assume standard GeoJSON structure: root -> features -> item
-            features = ijson.items(f, 'features.item')
-            for feature in features:
-                # Capture first geometry type
-                if first_geom_type is None:
-                    geom = feature.get('geometry')
-                    if geom and geom.get('type'):
-                        first_geom_type = geom.get('type')
-                
-                props = feature.get('properties')
-                if not props:
-                    continue
-                for key, value in props.items():
-                    if value is None:
-                        continue
-                    
-                    # Normalize type
-                    val_type = type(value)
-                    if val_type == bool:
-                        val_type = int
-                    elif val_type == Decimal:
-                        val_type = float
-                    
-                    current_type = properties_schema.get(key)
-                    
-                    if current_type is None:
-                        properties_schema[key] = val_type
-                    elif current_type == val_type:
-                        continue
-                    elif {current_type, val_type} <= {int, float}:
-                        properties_schema[key] = float
-                    else:
-                        properties_schema[key] = str
+        try:
+            # use_float yields native floats instead of boxing every number in Decimal
+            return spool_and_infer(input_path, spool_path, use_float=True)
+        except ijson.JSONError:
+            # yajl rejects integers beyond 64 bits when use_float is set; parse
+            # again with exact ints before reporting the input as invalid
+            return spool_and_infer(input_path, spool_path, use_float=False)
     except (ValueError, KeyError, ijson.JSONError) as e:
         raise fastapi.HTTPException(
             status_code=400,
             detail=f"Invalid GeoJSON format: {str(e)}"
         )
-                    
-    return properties_schema, first_geom_type
 
-def flatten_multi_geometry(feature):
+def has_wide_integer(view) -> bool:
+    """
+    True when the buffer may hold an integer orjson would round to a float:
+    a run of WIDE_INT_DIGITS digits that is not a fraction. Digits are folded
+    to '0' block by block so the runs are found with a plain bytes.find.
+    """
+    run = b'0' * WIDE_INT_DIGITS
+    for start in range(0, len(view), UPLOAD_CHUNK_SIZE):
+        # The overlap lets each block see runs crossing its start whole
+        offset = max(0, start - WIDE_INT_DIGITS)
+        block = view[offset:start + UPLOAD_CHUNK_SIZE].tobytes().translate(DIGIT_FOLD)
+        i = block.find(run)
+        while i != -1:
+            if i == 0:
+                # A run at the start of a later block was already checked by the previous block
+                if not offset:
+                    return True
+            elif block[i - 1] != ord('.'):
+                return True
+            i += WIDE_INT_DIGITS
+            while i < len(block) and block[i] == ord('0'):
+                i += 1
+            i = block.find(run, i)
+    return False
+
+def file_has_wide_integer(input_path: str) -> bool:
     """
-    Helper function to flatten MultiPolygon and MultiLineString geometries.
-    Returns a list of flattened features.
+    has_wide_integer over a whole file, read through a read-only mmap.
+    """
+    if not os.path.getsize(input_path):
+        return False
+    with open(input_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            return has_wide_integer(view)
+
+def load_features(input_path: str):
+    """
+    Decodes a small upload in one orjson call and returns its feature list,
+    or None when the file is too large, may hold integers orjson would not
+    decode exactly, or orjson rejects it, leaving the streaming path to
+    handle (and report) it.
+    """
+    size = os.path.getsize(input_path)
+    if not 0 < size <= IN_MEMORY_PARSE_LIMIT:
+        return None
+    # Decoding allocates millions of container objects; pausing the cyclic GC
+    # avoids repeated full collections that would cost several times the parse
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # orjson decodes straight from the mapped pages, so the upload is never
+        # copied into a bytes object alongside the decoded tree
+        with open(input_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                if has_wide_integer(view):
+                    return None
+                data = orjson.loads(view)
+    except orjson.JSONDecodeError:
+        return None
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    features = data.get('features') if isinstance(data, dict) else None
+    # Same result as ijson's 'features.item' prefix: anything but a list yields no features
+    return features if isinstance(features, list) else []
+
+def is_geojson_seq(input_path: str, content_type) -> bool:
+    """
+    True when the upload is declared as, or starts like, a GeoJSON text
+    sequence: an RS byte or a Feature object opening the first line.
+    """
+    if content_type == GEOJSON_SEQ_MEDIA_TYPE:
+        return True
+    with open(input_path, 'rb') as f:
+        head = f.read(HEAD_SNIFF_SIZE)
+    return GEOJSON_SEQ_SNIFF.match(head.lstrip(b' \t\r\n')) is not None
+
+def check_feature_collection_head(input_path: str):
+    """
+    Rejects uploads whose JSON root is not an object (e.g. a bare array of
+    features or a non-JSON file) before any parsing work is done.
+    """
+    with open(input_path, 'rb') as f:
+        head = f.read(HEAD_SNIFF_SIZE)
+    if not head.lstrip(JSON_LEADING_BYTES).startswith(b'{'):
+        raise fastapi.HTTPException(
+            status_code=400,
+            detail="Invalid GeoJSON format: expected a FeatureCollection object."
+        )
+
+def iter_seq_features(input_path: str, exact_lines: bool = False):
+    """
+    Generator that decodes a GeoJSON text sequence line by line. With
+    exact_lines, lines that may hold integers beyond 64 bits are decoded
+    exactly with the stdlib.
+    """
+    with open(input_path, 'rb') as f:
+        advise_sequential(f)
+        for line_number, line in enumerate(f, 1):
+            line = line.strip(b'\x1e \t\r\n')
+            if not line:
+                continue
+            try:
+                if exact_lines and has_wide_integer(memoryview(line)):
+                    # orjson would round the wide integers in this line to floats
+                    yield json.loads(line)
+                else:
+                    yield orjson.loads(line)
+            except (orjson.JSONDecodeError, json.JSONDecodeError) as e:
+                raise fastapi.HTTPException(
+                    status_code=400,
+                    detail=f"Invalid GeoJSON sequence at line {line_number}: {str(e)}"
+                )
+
+def flattened_geometry_type(geom_type: str) -> str:
+    """
+    Returns the single-part type a geometry type is written as after flattening.
+    """
+    return FLATTENED_TYPES.get(geom_type, geom_type)
+
+def iter_flat_geometries(feature):
+    """
+    Generator that flattens MultiPolygon and MultiLineString geometries.
+    Yields (geometry_type, coordinates, properties) tuples; single-part
+    geometries are passed through without copying.
     """
     geom = feature.get('geometry')
     if not geom:
-        return []
+        return
     
     geom_type = geom.get('type')
     coordinates = geom.get('coordinates')
-    props = feature.get('properties', {})
+    props = feature.get('properties') or {}
     
     # Validate coordinates exist
     if not coordinates:
-        return []
+        return
     
-    if geom_type == 'MultiPolygon':
-        return [
-            {
-                'type': 'Feature',
-                'geometry': {'type': 'Polygon', 'coordinates': poly_coords},
-                'properties': props
-            }
-            for poly_coords in coordinates
-        ]
-    elif geom_type == 'MultiLineString':
-        return [
-            {
+    single_type = FLATTENED_TYPES.get(geom_type)
+    if single_type:
+        for part_coords in coordinates:
+            yield single_type, part_coords, props
+    else:
+        yield geom_type, coordinates, props
+
+def iter_gpkg_features(features, target_geom_type: str, text_keys=()):
+    """
+    Generator that yields flattened features matching target_geom_type,
+    ready to be written to a GPKG layer. Values of text_keys are converted
+    to str, since OGR writes non-string values to text fields as NULL.
+    """
+    for feature in features:
+        for f_type, coords, f_props in iter_flat_geometries(feature):
+            # Validate geometry type matches schema
+            if f_type != target_geom_type:
+                continue
+            
+            # Text columns take the same str() form pyshp writes; this runs before the
+            # bool conversion so a bool in a text column reads 'True', not '1'
+            for k in text_keys:
+                v = f_props.get(k)
+                if v is not None and type(v) is not str:
+                    f_props[k] = str(v)
+            # Convert bools in place; the parsed feature is not used after this write
+            if bool in map(type, f_props.values()):
+                for k, v in f_props.items():
+                    if type(v) is bool:
+                        f_props[k] = int(v)
+            yield {
                 'type': 'Feature',
-                'geometry': {'type': 'LineString', 'coordinates': line_coords},
-                'properties': props
+                'geometry': {'type': f_type, 'coordinates': coords},
+                'properties': f_props
             }
-            for line_coords in coordinates
-        ]
+
+class ShapeWriter:
+    """
+    Writes .shp/.shx records for one 2D shape type with struct, in the same
+    layout pyshp produces. Packing straight from GeoJSON coordinates skips
+    building a pyshp Shape per feature, which cost more than the packing.
+    """
+    def __init__(self, shp, shx, shape_type: int):
+        self.shp = shp
+        self.shx = shx
+        self.shape_type = shape_type
+        self.num_records = 0
+        self.offset = SHP_HEADER_SIZE
+        self.bbox = None
+        # Headers are written on close, once the length and bbox are known
+        shp.write(bytes(SHP_HEADER_SIZE))
+        shx.write(bytes(SHP_HEADER_SIZE))
+
+    def write(self, geom_type: str, coordinates) -> bool:
+        """
+        Writes one record. Empty rings and parts are dropped; returns False,
+        writing nothing, when no points are left.
+        """
+        if geom_type == 'Point':
+            x, y = coordinates[0], coordinates[1]
+            content = SHP_POINT_RECORD.pack(self.shape_type, x, y)
+            bbox = (x, y, x, y)
+        else:
+            if geom_type == 'Polygon':
+                # Shapefile rings run clockwise for the exterior and counter-clockwise for holes
+                xs, ys, parts = [], [], []
+                for ring in coordinates:
+                    if not ring:
+                        continue
+                    ring_xs = [p[0] for p in ring]
+                    ring_ys = [p[1] for p in ring]
+                    # The first ring written is the exterior
+                    if (not parts) != (ring_signed_area(ring_xs, ring_ys) < 0):
+                        ring_xs.reverse()
+                        ring_ys.reverse()
+                    parts.append(len(xs))
+                    xs += ring_xs
+                    ys += ring_ys
+            else:
+                xs = [p[0] for p in coordinates]
+                ys = [p[1] for p in coordinates]
+                parts = [0]
+
+            num_points = len(xs)
+            if not num_points:
+                return False
+            flat = [0.0] * (2 * num_points)
+            flat[0::2] = xs
+            flat[1::2] = ys
+            bbox = (min(xs), min(ys), max(xs), max(ys))
+            content = SHP_BOX_HEADER.pack(self.shape_type, *bbox)
+            if self.shape_type == shapefile.MULTIPOINT:
+                content += struct.pack('<i', num_points)
+            else:
+                content += struct.pack(f'<2i{len(parts)}i', len(parts), num_points, *parts)
+            content += struct.pack(f'<{2 * num_points}d', *flat)
+
+        self.num_records += 1
+        length = len(content)
+        self.shp.write(SHP_RECORD_HEADER.pack(self.num_records, length // 2))
+        self.shp.write(content)
+        self.shx.write(SHP_RECORD_HEADER.pack(self.offset // 2, length // 2))
+        self.offset += 8 + length
+
+        if self.bbox is None:
+            self.bbox = bbox
+        else:
+            xmin, ymin, xmax, ymax = self.bbox
+            self.bbox = (min(bbox[0], xmin), min(bbox[1], ymin), max(bbox[2], xmax), max(bbox[3], ymax))
+        return True
+
+    def close(self):
+        bbox = self.bbox or (0, 0, 0, 0)
+        for f, length in ((self.shp, self.offset), (self.shx, SHP_HEADER_SIZE + 8 * self.num_records)):
+            f.seek(0)
+            f.write(struct.pack('>7i', 9994, 0, 0, 0, 0, 0, length // 2))
+            # Z and M ranges are zero for 2D shape types
+            f.write(struct.pack('<2i8d', 1000, self.shape_type, *bbox, 0, 0, 0, 0))
+            f.seek(0, os.SEEK_END)
+
+def ring_signed_area(xs, ys) -> float:
+    """
+    Twice the signed area of a ring; negative for clockwise rings. Same
+    arithmetic and summation order as shapefile.signed_area.
+    """
+    return sum(x * (y_next - y_prev) for x, y_next, y_prev in zip(xs[1:], ys[2:] + ys[1:2], ys[:-1]))
+
+class ZipStream(io.RawIOBase):
+    """
+    Write-only sink for zipfile that queues written bytes so they can be
+    yielded to the client as soon as they are produced.
+    """
+    def __init__(self):
+        self._chunks = collections.deque()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        while self._chunks:
+            yield self._chunks.popleft()
+
+def iter_zip(entries, stored: bool = False):
+    """
+    Generator that zips (arcname, file object or bytes) entries on the fly,
+    yielding archive bytes incrementally instead of buffering the whole zip.
+    Each file object is closed once it has been written. With stored=True
+    entries are not deflated, leaving compression to the transport layer.
+    """
+    stream = ZipStream()
+    if stored:
+        zf = zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED)
+    else:
+        # Level 1 keeps most of the size reduction at a fraction of the default level's CPU cost
+        zf = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED, compresslevel=1)
+    with zf:
+        for arcname, src in entries:
+            if isinstance(src, bytes):
+                zf.writestr(arcname, src)
+                yield from stream.drain()
+                continue
+            with src, zf.open(arcname, 'w') as dst:
+                src.seek(0)
+                while chunk := src.read(ZIP_CHUNK_SIZE):
+                    dst.write(chunk)
+                    yield from stream.drain()
+    # Central directory is written on close
+    yield from stream.drain()
+
+def iter_encoded(chunks, encoding: str):
+    """
+    Generator that compresses a byte stream with zstd or brotli. Like the
+    zip writer it feeds, it runs in StreamingResponse's threadpool
+    iteration, so the compression never blocks the event loop.
+    """
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        compress, finish = compressor.compress, compressor.flush
     else:
-        return [feature]
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    for chunk in chunks:
+        if out := compress(chunk):
+            yield out
+    yield finish()
 
-def process_conversion(temp_dir: str, input_geojson_path: str, name: str, output_format: str):
+def process_conversion(temp_dir: str, input_geojson_path: str, name: str, output_format: str,
+                       store_zip: bool = False, input_seq: bool = False):
     """
     Synchronous function to handle the CPU-bound conversion process.
+    store_zip skips deflating the shapefile archive when the response
+    will be compressed in transit anyway. input_seq marks the upload as a
+    GeoJSON text sequence rather than a FeatureCollection.
     """
-    # 1. Infer Schema and get first geometry type (Pass 1)
-    properties_schema, first_geom_type = infer_schema_streaming(input_geojson_path)
+    # 1. Infer Schema and get first geometry type. Sequences are already line-delimited
+    # and are read twice; small collections are parsed in memory; larger ones are
+    # spooled to NDJSON for the write pass.
+    if input_seq:
+        # One scan of the file spares sequences without wide integers a check per line
+        exact_lines = file_has_wide_integer(input_geojson_path)
+        properties_schema, first_geom_type, text_widths, wide_int_keys = infer_schema(
+            iter_seq_features(input_geojson_path, exact_lines)
+        )
+        features = iter_seq_features(input_geojson_path, exact_lines)
+    else:
+        check_feature_collection_head(input_geojson_path)
+        if (features := load_features(input_geojson_path)) is not None:
+            properties_schema, first_geom_type, text_widths, wide_int_keys = infer_schema(features)
+        else:
+            spool_path = os.path.join(temp_dir, "features.ndjson")
+            properties_schema, first_geom_type, text_widths, wide_int_keys = infer_schema_streaming(input_geojson_path, spool_path)
+            features = iter_spooled_features(spool_path)
+        # The features are in memory or spooled; free the upload's scratch space before writing
+        os.unlink(input_geojson_path)
     
     if not first_geom_type:
         raise fastapi.HTTPException(status_code=400, detail="No features with geometry found.")
     
     if output_format == 'shp':
-        shapefile_path = os.path.join(temp_dir, name)
-
-        shapetype_map = {
-            "Point": shapefile.POINT,
-            "MultiPoint": shapefile.MULTIPOINT,
-            "LineString": shapefile.POLYLINE,
-            "MultiLineString": shapefile.POLYLINE, # Flattened
-            "Polygon": shapefile.POLYGON,
-            "MultiPolygon": shapefile.POLYGON, # Flattened
-        }
-        
         # Handle flattening logic mapping
         # If it's MultiPolygon, we treat it as Polygon for the shapefile type, 
         # but we must flatten the features later.
-        base_geom_type = first_geom_type
-        if base_geom_type == 'MultiPolygon':
-            base_geom_type = 'Polygon'
-        elif base_geom_type == 'MultiLineString':
-            base_geom_type = 'LineString'
+        base_geom_type = flattened_geometry_type(first_geom_type)
 
-        shape_type = shapetype_map.get(base_geom_type)
+        shape_type = SHAPETYPE_MAP.get(base_geom_type)
         if shape_type is None:
             raise fastapi.HTTPException(status_code=400, detail=f"Unsupported geometry type: {first_geom_type}")
 
-        with shapefile.Writer(shapefile_path, shapeType=shape_type) as w:
+        # The components are written into spooled buffers that go straight into the zip,
+        # so the components never round-trip through the temp dir
+        shp_file, shx_file, dbf_file = (
+            tempfile.SpooledTemporaryFile(max_size=SHAPEFILE_SPOOL_SIZE) for _ in range(3)
+        )
+        shape_writer = ShapeWriter(shp_file, shx_file, shape_type)
+        with shapefile.Writer(dbf=dbf_file) as w:
             # Define fields and maintain mapping
             field_names = []  # Original property keys in order
-            field_name_map = {}  # Original key -> Shapefile field name
             seen_fields = set()
+            next_suffix = {}  # Truncated name -> first suffix not yet tried for it
             
             for key, val_type in properties_schema.items():
-                # Handle 10 char limit and uniqueness
+                # Handle 10 char limit and uniqueness. Suffixes below next_suffix are
+                # already taken, so each collision resumes where the last one stopped.
                 base_name = key[:10]
                 final_name = base_name
-                counter = 1
+                counter = next_suffix.get(base_name, 1)
                 while final_name in seen_fields:
                     suffix = str(counter)
                     final_name = base_name[:10-len(suffix)] + suffix
                     counter += 1
+                next_suffix[base_name] = counter
                 
                 seen_fields.add(final_name)
                 field_names.append(key)
-                field_name_map[key] = final_name
 
-                if val_type == int:
-                    w.field(final_name, 'N')
-                elif val_type == float:
-                    w.field(final_name, 'F', size=18, decimal=10)
-                else:
-                    w.field(final_name, 'C', size=254)
+                field_type, size, decimal = SHP_FIELD_SPECS.get(val_type, SHP_FIELD_SPECS[str])
+                if field_type == 'C':
+                    # Size text fields to the widest value instead of always 254
+                    size = max(1, min(size, text_widths.get(key, 1)))
+                w.field(final_name, field_type, size, decimal)
 
             # Pass 2: Write features
-            with open(input_geojson_path, 'rb') as f:
-                features = ijson.items(f, 'features.item')
+            try:
                 for feature in features:
-                    # Use helper function for flattening
-                    features_to_write = flatten_multi_geometry(feature)
-
-                    for feat in features_to_write:
-                        f_geom = feat.get('geometry')
-                        f_props = feat.get('properties', {})
-                        
+                    for f_type, coords, f_props in iter_flat_geometries(feature):
                         # Check geometry match (using base type)
-                        f_type = f_geom.get('type')
                         if f_type != base_geom_type:
                             logging.warning(f"Skipping feature with mismatched geometry: {f_type} (expected {base_geom_type})")
                             continue
 
-                        w.shape(f_geom)
+                        if not shape_writer.write(f_type, coords):
+                            logging.warning(f"Skipping feature with empty geometry: {f_type}")
+                            continue
                         
-                        record_values = []
-                        for key in field_names:
-                            val = f_props.get(key)
-                            if val is None:
-                                record_values.append(None)
-                            elif properties_schema[key] == int and isinstance(val, bool):
-                                record_values.append(int(val))
-                            else:
-                                record_values.append(val)
+                        # pyshp coerces bools in numeric fields itself, so values pass through as-is
+                        record_values = list(map(f_props.get, field_names))
+                        if None in record_values:
+                            # pyshp would write None as the text "None"; '' is blank/NULL for every field type
+                            record_values = ['' if val is None else val for val in record_values]
                         w.record(*record_values)
+            except (TypeError, ValueError, IndexError, struct.error) as e:
+                # Malformed positions, e.g. an empty or non-numeric point
+                raise fastapi.HTTPException(
+                    status_code=400,
+                    detail=f"Invalid feature for SHP output: {str(e)}"
+                )
+        shape_writer.close()
 
-        with open(f"{shapefile_path}.prj", "w") as prj_file:
-            prj_file.write(WGS84_PRJ)
-
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for ext in ['shp', 'shx', 'dbf', 'prj']:
-                filepath = os.path.join(temp_dir, f"{name}.{ext}")
-                if os.path.exists(filepath):
-                    zf.write(filepath, arcname=f"{name}.{ext}")
-        zip_buffer.seek(0)
-        return zip_buffer, "application/zip", f"{name}.zip"
+        entries = [
+            (f"{name}.shp", shp_file),
+            (f"{name}.shx", shx_file),
+            (f"{name}.dbf", dbf_file),
+            (f"{name}.prj", WGS84_PRJ.encode('ascii')),
+        ]
+        return iter_zip(entries, stored=store_zip), "application/zip", f"{name}.zip"
 
     elif output_format == 'gpkg':
         gpkg_path = os.path.join(temp_dir, f"{name}.gpkg")
 
         # Flattening logic implies we target the single type
-        target_geom_type = first_geom_type
-        if target_geom_type == 'MultiPolygon':
-            target_geom_type = 'Polygon'
-        elif target_geom_type == 'MultiLineString':
-            target_geom_type = 'LineString'
+        target_geom_type = flattened_geometry_type(first_geom_type)
 
         schema = {
             'geometry': target_geom_type,
             'properties': {}
         }
         
-        type_mapping = {
-            str: 'str',
-            int: 'int',
-            float: 'float',
-            bool: 'int'
-        }
-        
+        text_keys = []
         for key, val_type in properties_schema.items():
-            schema['properties'][key] = type_mapping.get(val_type, 'str')
+            field_type = GPKG_FIELD_TYPES.get(val_type, 'str')
+            if val_type is int and key in wide_int_keys:
+                # Wider integers may overflow int64; text keeps them exact
+                field_type = 'str'
+            if field_type == 'str':
+                # Promoted columns still hold non-string values
+                text_keys.append(key)
+            schema['properties'][key] = field_type
 
-        with fiona.open(gpkg_path, 'w', driver='GPKG', schema=schema, crs=from_epsg(4326)) as sink:
-             with open(input_geojson_path, 'rb') as f:
-                features = ijson.items(f, 'features.item')
-                for feature in features:
-                    # Use helper function for flattening
-                    features_to_write = flatten_multi_geometry(feature)
-
-                    for feat in features_to_write:
-                        # Validate geometry type matches schema
-                        if feat['geometry']['type'] != target_geom_type:
-                            continue
-                        
-                        # Convert bools and Decimals
-                        if 'properties' in feat:
-                            feat['properties'] = {
-                                k: (int(v) if isinstance(v, bool) else 
-                                    float(v) if isinstance(v, Decimal) else v)
-                                for k, v in feat['properties'].items()
-                            }
-                        
-                        try:
-                            sink.write(feat)
-                        except Exception as e:
-                            logging.warning(f"Skipping feature due to write error: {e}")
+        with fiona.Env(**GPKG_WRITE_OPTIONS):
+            with fiona.open(gpkg_path, 'w', driver='GPKG', schema=schema, crs=from_epsg(4326)) as sink:
+                try:
+                    # Bulk write batches the inserts into a few transactions instead of one per feature
+                    sink.writerecords(iter_gpkg_features(features, target_geom_type, text_keys))
+                except (TypeError, ValueError) as e:
+                    # A failed write leaves the GPKG unreadable, so there is no partial file to return
+                    raise fastapi.HTTPException(
+                        status_code=400,
+                        detail=f"Invalid feature for GPKG output: {str(e)}"
+                    )
 
         return gpkg_path, "application/geopackage+sqlite3", f"{name}.gpkg"
 
 
 @app.post("/convert")
 async def convert_geojson(
+    request: fastapi.Request,
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     name: str = Form(...),
     format: Literal['shp', 'gpkg'] = Form('shp')
 ):
-    if "/" in name or "\\" in name or ".." in name:
+    if not NAME_PATTERN.fullmatch(name):
         raise fastapi.HTTPException(status_code=400, detail="Invalid name.")
     
     # Validate file size (50MB limit)
-    MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
     file_size = 0
 
     temp_dir = tempfile.mkdtemp()
@@ -312,7 +836,7 @@ async def convert_geojson(
     try:
         # Stream upload to temp file with size validation
         with open(input_geojson_path, "wb") as buffer:
-            while chunk := await file.read(8192):  # Read in 8KB chunks
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
                 file_size += len(chunk)
                 if file_size > MAX_FILE_SIZE:
                     raise fastapi.HTTPException(
@@ -322,7 +846,14 @@ async def convert_geojson(
                 buffer.write(chunk)
         
         # Offload CPU-bound conversion to threadpool
-        result = await run_in_threadpool(process_conversion, temp_dir, input_geojson_path, name, format)
+        # Skip deflating the archive when the response will be compressed in transit;
+        # repeated Accept-Encoding headers are read as one comma-joined list
+        transport_encoding = negotiate_transport_encoding(','.join(request.headers.getlist('accept-encoding')))
+        input_seq = is_geojson_seq(input_geojson_path, file.content_type)
+        result = await run_in_threadpool(
+            process_conversion, temp_dir, input_geojson_path, name, format,
+            transport_encoding is not None, input_seq
+        )
         
         content, media_type, filename = result
         
@@ -336,12 +867,19 @@ async def convert_geojson(
                 background=background_tasks
             )
         else:
-            # If result is bytes buffer (Zip), return StreamingResponse
+            # If result is a zip generator, stream it as it is produced
+            headers = {
+                "Content-Disposition": f'attachment; filename="{filename}"',
+                "Vary": "Accept-Encoding",
+            }
+            if transport_encoding:
+                content = iter_encoded(content, transport_encoding)
+                headers["Content-Encoding"] = transport_encoding
             background_tasks.add_task(cleanup_temp_dir, temp_dir)
             return StreamingResponse(
                 content,
                 media_type=media_type,
-                headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+                headers=headers,
                 background=background_tasks
             )
 
@@ -0,0 +1,110 @@
+import io
+import json
+import types
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+from main import app
+
+
+@pytest.fixture(scope="session")
+def client():
+    # One app startup (and lifespan) for the whole test session
+    with TestClient(app) as c:
+        yield c
+
+
+def geojson_fixture(data):
+    # Encoded once per session; tests post .body and read .data
+    return types.SimpleNamespace(data=data, body=json.dumps(data).encode('utf-8'))
+
+
+# Fixtures for test data
+@pytest.fixture(scope="session")
+def points_geojson():
+    return geojson_fixture({
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [10, 20]},
+                "properties": {"name": "A"},
+            }
+        ],
+    })
+
+@pytest.fixture(scope="session")
+def polygons_geojson():
+    return geojson_fixture({
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]],
+                },
+                "properties": {"id": 1},
+            }
+        ],
+    })
+
+@pytest.fixture(scope="session")
+def mixed_polygons_geojson():
+    return geojson_fixture({
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[0, 0], [0, 1], [1, 1], [0, 0]]],
+                },
+                "properties": {"type": "single"},
+            },
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "MultiPolygon",
+                    "coordinates": [
+                        [[[10, 10], [10, 11], [11, 11], [10, 10]]],
+                        [[[20, 20], [20, 21], [21, 21], [20, 20]]],
+                    ],
+                },
+                "properties": {"type": "multi"},
+            },
+        ],
+    })
+
+@pytest.fixture(scope="session")
+def mixed_incompatible_geojson():
+    return geojson_fixture({
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [0, 0]},
+                "properties": {"id": 1},
+            },
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[10, 10], [10, 11], [11, 11], [10, 10]]],
+                },
+                "properties": {"id": 2},
+            },
+        ],
+    })
+
+
+def assert_zip_namelist(response, expected):
+    """
+    Asserts the response is a zip holding exactly the expected members and
+    returns its ZipInfo entries for further checks.
+    """
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        assert set(zf.namelist()) == expected
+        return zf.infolist()
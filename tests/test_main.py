@@ -1,165 +1,249 @@
 import pytest
-from fastapi.testclient import TestClient
 import zipfile
 import io
 import json
+import shapefile
+import fiona
 
-from main import app
+from conftest import assert_zip_namelist
 
-client = TestClient(app)
+# Members of a zipped shapefile response
+SHP_EXTS = ("shp", "shx", "dbf", "prj")
 
-# Fixtures for test data
-@pytest.fixture
-def points_geojson():
-    return {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": {"type": "Point", "coordinates": [10, 20]},
-                "properties": {"name": "A"},
-            }
-        ],
-    }
+# Request bodies for the error cases, encoded once at import
+INVALID_BODY = b'{"type":"Invalid"}'
+EMPTY_FC_BODY = b'{"type":"FeatureCollection","features":[]}'
+GEOM_COLLECTION_BODY = json.dumps({
+    "type": "FeatureCollection",
+    "features": [{"type": "Feature", "geometry": {"type": "GeometryCollection", "geometries": []}, "properties": {}}]
+}).encode('utf-8')
 
-@pytest.fixture
-def polygons_geojson():
-    return {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Polygon",
-                    "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]],
-                },
-                "properties": {"id": 1},
-            }
-        ],
-    }
 
-@pytest.fixture
-def mixed_polygons_geojson():
-    return {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Polygon",
-                    "coordinates": [[[0, 0], [0, 1], [1, 1], [0, 0]]],
-                },
-                "properties": {"type": "single"},
-            },
-            {
-                "type": "Feature",
-                "geometry": {
-                    "type": "MultiPolygon",
-                    "coordinates": [
-                        [[[10, 10], [10, 11], [11, 11], [10, 10]]],
-                        [[[20, 20], [20, 21], [21, 21], [20, 20]]],
-                    ],
-                },
-                "properties": {"type": "multi"},
-            },
-        ],
-    }
+def shp_files(name):
+    return {f"{name}.{ext}" for ext in SHP_EXTS}
 
-@pytest.fixture
-def mixed_incompatible_geojson():
-    return {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": {"type": "Point", "coordinates": [0, 0]},
-                "properties": {"id": 1},
-            },
-            {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Polygon",
-                    "coordinates": [[[10, 10], [10, 11], [11, 11], [10, 10]]],
-                },
-                "properties": {"id": 2},
-            },
-        ],
-    }
 
+@pytest.mark.parametrize("fixture_name,filename,name,fmt,expected_ct,expected_geometry,expected_count", [
+    ("points_geojson", "points.json", "test_points", "shp", "application/zip", "Point", 1),
+    ("points_geojson", "points.json", "test_points_gpkg", "gpkg", "application/geopackage+sqlite3", "Point", 1),
+    # The MultiPolygon is flattened into one feature per part
+    ("mixed_polygons_geojson", "mixed.json", "test_mixed_polygons", "shp", "application/zip", "Polygon", 3),
+    ("mixed_polygons_geojson", "mixed.json", "test_mixed_polygons_gpkg", "gpkg", "application/geopackage+sqlite3", "Polygon", 3),
+    # The first feature (Point) sets the type; the Polygon is skipped and a valid zip is still returned
+    ("mixed_incompatible_geojson", "mismatched.json", "mismatched", "shp", "application/zip", "Point", 1),
+])
+def test_convert_success(client, request, fixture_name, filename, name, fmt, expected_ct,
+                         expected_geometry, expected_count):
+    geojson = request.getfixturevalue(fixture_name)
+    response = client.post(
+        "/convert",
+        files={"file": (filename, geojson.body, "application/json")},
+        data={"name": name, "format": fmt}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == expected_ct
 
-def test_convert_points_success(points_geojson):
-    geojson_content = json.dumps(points_geojson).encode('utf-8')
+    if fmt == "shp":
+        # Check if the zip file is valid and contains the expected files
+        assert_zip_namelist(response, shp_files(name))
+    else:
+        assert response.headers["content-disposition"] == f'attachment; filename="{name}.gpkg"'
+
+    # Both outputs open through GDAL straight from the response bytes
+    with fiona.BytesCollection(response.content) as source:
+        assert source.schema["geometry"] == expected_geometry
+        assert len(source) == expected_count
+        assert source.crs.to_epsg() == 4326
+
+def test_convert_points_zip_compression_negotiation(client, points_geojson):
+    geojson_content = points_geojson.body
+    expected = shp_files("test_points")
+
+    # Without transport compression the archive itself is deflated
     response = client.post(
         "/convert",
         files={"file": ("points.json", geojson_content, "application/json")},
-        data={"name": "test_points", "format": "shp"}
+        data={"name": "test_points", "format": "shp"},
+        headers={"Accept-Encoding": "identity"}
     )
     assert response.status_code == 200
-    assert response.headers["content-type"] == "application/zip"
-    
-    # Check if the zip file is valid and contains the expected files
-    zip_buffer = io.BytesIO(response.content)
-    with zipfile.ZipFile(zip_buffer, 'r') as zf:
-        assert set(zf.namelist()) == {'test_points.shp', 'test_points.shx', 'test_points.dbf', 'test_points.prj'}
+    assert "content-encoding" not in response.headers
+    infos = assert_zip_namelist(response, expected)
+    assert all(info.compress_type == zipfile.ZIP_DEFLATED for info in infos)
 
-def test_convert_points_to_gpkg_success(points_geojson):
-    geojson_content = json.dumps(points_geojson).encode('utf-8')
+    # With zstd the response is compressed in transit and the archive is stored
     response = client.post(
         "/convert",
         files={"file": ("points.json", geojson_content, "application/json")},
-        data={"name": "test_points_gpkg", "format": "gpkg"}
+        data={"name": "test_points", "format": "shp"},
+        headers={"Accept-Encoding": "zstd"}
     )
     assert response.status_code == 200
-    # Recommended MIME type, could also be application/octet-stream
-    assert response.headers["content-type"] == "application/geopackage+sqlite3"
-    assert response.headers["content-disposition"] == 'attachment; filename="test_points_gpkg.gpkg"'
-    # Further validation could involve trying to open the GPKG file with Fiona or GDAL
-    # For now, we'll assume a 200 OK and correct headers mean success.
-    # To do more:
-    # import fiona
-    # with fiona.BytesCollection(response.content) as source:
-    #     assert len(source) == 1
-    #     # Check CRS, schema, etc.
+    assert response.headers["content-encoding"] == "zstd"
+    infos = assert_zip_namelist(response, expected)
+    assert all(info.compress_type == zipfile.ZIP_STORED for info in infos)
+
+    # The archive is stored only when the response really is compressed in transit
+    for accept_encoding, expected_encoding in (
+        ("zstd;q=0, br;q=0, *", None),
+        ("zstd;q=abc", None),
+        ("zstd;q=0, *", "br"),
+    ):
+        response = client.post(
+            "/convert",
+            files={"file": ("points.json", geojson_content, "application/json")},
+            data={"name": "test_points", "format": "shp"},
+            headers={"Accept-Encoding": accept_encoding}
+        )
+        assert response.status_code == 200
+        assert response.headers.get("content-encoding") == expected_encoding
+        infos = assert_zip_namelist(response, expected)
+        compress_type = zipfile.ZIP_STORED if expected_encoding else zipfile.ZIP_DEFLATED
+        assert all(info.compress_type == compress_type for info in infos)
 
-def test_convert_mixed_polygons_success(mixed_polygons_geojson):
-    geojson_content = json.dumps(mixed_polygons_geojson).encode('utf-8')
+    # GPKG files are sent as they are
     response = client.post(
         "/convert",
-        files={"file": ("mixed.json", geojson_content, "application/json")},
-        data={"name": "test_mixed_polygons", "format": "shp"}
+        files={"file": ("points.json", geojson_content, "application/json")},
+        data={"name": "test_points", "format": "gpkg"},
+        headers={"Accept-Encoding": "zstd, br"}
     )
     assert response.status_code == 200
-    assert response.headers["content-type"] == "application/zip"
-    
-    zip_buffer = io.BytesIO(response.content)
-    with zipfile.ZipFile(zip_buffer, 'r') as zf:
-        assert set(zf.namelist()) == {'test_mixed_polygons.shp', 'test_mixed_polygons.shx', 'test_mixed_polygons.dbf', 'test_mixed_polygons.prj'}
+    assert "content-encoding" not in response.headers
+
+def test_convert_mixed_polygons_streaming_matches_in_memory(client, mixed_polygons_geojson, monkeypatch):
+    geojson_content = mixed_polygons_geojson.body
+
+    def convert():
+        response = client.post(
+            "/convert",
+            files={"file": ("mixed.json", geojson_content, "application/json")},
+            data={"name": "test_streaming", "format": "shp"}
+        )
+        assert response.status_code == 200
+        with zipfile.ZipFile(io.BytesIO(response.content), 'r') as zf:
+            return {n: zf.read(n) for n in zf.namelist()}
+
+    in_memory = convert()
+    # Force the ijson/NDJSON spool path used for large uploads
+    monkeypatch.setattr("main.IN_MEMORY_PARSE_LIMIT", 0)
+    assert convert() == in_memory
 
-def test_convert_mixed_polygons_to_gpkg_success(mixed_polygons_geojson):
-    geojson_content = json.dumps(mixed_polygons_geojson).encode('utf-8')
+def test_convert_gpkg_int64_bounds(client):
+    # 19+ character ints inside the 64-bit range stay integer fields
+    props = {"max": 2 ** 63 - 1, "min": -2 ** 63, "neg": -123456789012345678}
+    geojson_content = json.dumps({
+        "type": "FeatureCollection",
+        "features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [0, 0]}, "properties": props}]
+    }).encode('utf-8')
     response = client.post(
         "/convert",
-        files={"file": ("mixed.json", geojson_content, "application/json")},
-        data={"name": "test_mixed_polygons_gpkg", "format": "gpkg"}
+        files={"file": ("int64.json", geojson_content, "application/json")},
+        data={"name": "int64", "format": "gpkg"}
     )
     assert response.status_code == 200
-    assert response.headers["content-type"] == "application/geopackage+sqlite3"
-    assert response.headers["content-disposition"] == 'attachment; filename="test_mixed_polygons_gpkg.gpkg"'
-    # As above, further validation of the GPKG content could be added.
+    with fiona.BytesCollection(response.content) as source:
+        assert all(source.schema["properties"][k].startswith("int") for k in props)
+        assert dict(next(iter(source))["properties"]) == props
 
-def test_convert_invalid_geojson():
-    geojson_content = json.dumps({"type": "Invalid"}).encode('utf-8')
+def test_convert_gpkg_mixed_text_column(client):
+    # "m" is promoted to text; OGR would write its non-string values as NULL
+    values = ["a", 10, 1.5, True, [1, 2]]
+    geojson_content = json.dumps({
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [i, i]}, "properties": {"m": v}}
+            for i, v in enumerate(values)
+        ]
+    }).encode('utf-8')
     response = client.post(
         "/convert",
-        files={"file": ("invalid.json", geojson_content, "application/json")},
+        files={"file": ("mixed_values.json", geojson_content, "application/json")},
+        data={"name": "mixed_values", "format": "gpkg"}
+    )
+    assert response.status_code == 200
+    with fiona.BytesCollection(response.content) as source:
+        assert source.schema["properties"]["m"].startswith("str")
+        # Same text the shapefile's DBF gets
+        assert [f["properties"]["m"] for f in source] == ["a", "10", "1.5", "True", "[1, 2]"]
+
+@pytest.mark.parametrize("source", ["in_memory", "streaming", "seq"])
+@pytest.mark.parametrize("fmt", ["shp", "gpkg"])
+def test_convert_wide_integer(client, monkeypatch, fmt, source):
+    # Integers beyond 64 bits are valid JSON; yajl's use_float mode rejects them
+    # and orjson would round them to floats
+    feature = {"type": "Feature", "geometry": {"type": "Point", "coordinates": [1.5, 2.5]},
+               "properties": {"big": 123456789012345678901234567890}}
+    if source == "seq":
+        geojson_content = b"\x1e" + json.dumps(feature).encode('utf-8') + b"\n"
+        content_type = "application/geo+json-seq"
+    else:
+        geojson_content = json.dumps({"type": "FeatureCollection", "features": [feature]}).encode('utf-8')
+        content_type = "application/json"
+    if source == "streaming":
+        monkeypatch.setattr("main.IN_MEMORY_PARSE_LIMIT", 0)
+    response = client.post(
+        "/convert",
+        files={"file": ("wide.json", geojson_content, content_type)},
+        data={"name": "wide", "format": fmt}
+    )
+    assert response.status_code == 200
+    with fiona.BytesCollection(response.content) as source:
+        feature = next(iter(source))
+        assert tuple(feature["geometry"]["coordinates"]) == (1.5, 2.5)
+        if fmt == "gpkg":
+            # Too wide for a 64-bit integer field, so stored as exact text
+            assert feature["properties"]["big"] == "123456789012345678901234567890"
+
+    if fmt == "shp":
+        # OGR reads N(50) fields as float, so check the exact value through pyshp
+        with zipfile.ZipFile(io.BytesIO(response.content), 'r') as zf:
+            reader = shapefile.Reader(dbf=io.BytesIO(zf.read("wide.dbf")))
+            assert reader.record(0)["big"] == 123456789012345678901234567890
+
+def test_convert_geojson_seq(client, mixed_polygons_geojson):
+    features = mixed_polygons_geojson.data["features"]
+    # RFC 8142 record separators, declared by media type
+    rs_content = b"".join(b"\x1e" + json.dumps(f).encode('utf-8') + b"\n" for f in features)
+    # Plain newline-delimited features, detected from the first line
+    nd_content = b"".join(json.dumps(f, separators=(',', ':')).encode('utf-8') + b"\n" for f in features)
+
+    for content, content_type in ((rs_content, "application/geo+json-seq"), (nd_content, "text/plain")):
+        response = client.post(
+            "/convert",
+            files={"file": ("mixed.geojsonl", content, content_type)},
+            data={"name": "test_seq", "format": "shp"}
+        )
+        assert response.status_code == 200
+        with zipfile.ZipFile(io.BytesIO(response.content), 'r') as zf:
+            reader = shapefile.Reader(shp=io.BytesIO(zf.read("test_seq.shp")),
+                                      dbf=io.BytesIO(zf.read("test_seq.dbf")))
+            # The MultiPolygon is flattened into one record per part
+            assert [r["type"] for r in reader.records()] == ["single", "multi", "multi"]
+
+def test_convert_invalid_geojson(client):
+    response = client.post(
+        "/convert",
+        files={"file": ("invalid.json", INVALID_BODY, "application/json")},
         data={"name": "test_invalid", "format": "shp"}
     )
     assert response.status_code == 400
     # New error message from process_conversion when no features found
     assert "No features with geometry found" in response.json()["detail"]
 
-def test_convert_invalid_name(points_geojson):
-    geojson_content = json.dumps(points_geojson).encode('utf-8')
+def test_convert_feature_array_rejected(client, points_geojson):
+    # A bare array of features is rejected from the file header, before parsing
+    geojson_content = json.dumps(points_geojson.data["features"]).encode('utf-8')
+    response = client.post(
+        "/convert",
+        files={"file": ("features.json", geojson_content, "application/json")},
+        data={"name": "test_array", "format": "shp"}
+    )
+    assert response.status_code == 400
+    assert "expected a FeatureCollection" in response.json()["detail"]
+
+def test_convert_invalid_name(client, points_geojson):
+    geojson_content = points_geojson.body
     response = client.post(
         "/convert",
         files={"file": ("points.json", geojson_content, "application/json")},
@@ -168,8 +252,18 @@ def test_convert_invalid_name(points_geojson):
     assert response.status_code == 400
     assert "Invalid name" in response.json()["detail"]
 
-def test_convert_invalid_format(points_geojson):
-    geojson_content = json.dumps(points_geojson).encode('utf-8')
+def test_convert_invalid_name_characters(client, points_geojson):
+    geojson_content = points_geojson.body
+    response = client.post(
+        "/convert",
+        files={"file": ("points.json", geojson_content, "application/json")},
+        data={"name": 'bad"name', "format": "shp"}
+    )
+    assert response.status_code == 400
+    assert "Invalid name" in response.json()["detail"]
+
+def test_convert_invalid_format(client, points_geojson):
+    geojson_content = points_geojson.body
     response = client.post(
         "/convert",
         files={"file": ("points.json", geojson_content, "application/json")},
@@ -177,43 +271,118 @@ def test_convert_invalid_format(points_geojson):
     )
     assert response.status_code == 422 # FastAPI's validation error for Literal
 
-def test_convert_no_features():
-    geojson_content = json.dumps({"type": "FeatureCollection", "features": []}).encode('utf-8')
+def test_convert_no_features(client):
     response = client.post(
         "/convert",
-        files={"file": ("no_features.json", geojson_content, "application/json")},
+        files={"file": ("no_features.json", EMPTY_FC_BODY, "application/json")},
         data={"name": "no_features", "format": "shp"}
     )
     assert response.status_code == 400
     assert "No features with geometry found" in response.json()["detail"]
 
-def test_convert_unsupported_geometry():
-    geojson = {
-        "type": "FeatureCollection",
-        "features": [{"type": "Feature", "geometry": {"type": "GeometryCollection", "geometries": []}, "properties": {}}]
-    }
-    geojson_content = json.dumps(geojson).encode('utf-8')
+def test_convert_unsupported_geometry(client):
     response = client.post(
         "/convert",
-        files={"file": ("unsupported.json", geojson_content, "application/json")},
+        files={"file": ("unsupported.json", GEOM_COLLECTION_BODY, "application/json")},
         data={"name": "unsupported", "format": "shp"}
     )
     assert response.status_code == 400
     # Error message changed
     assert "Unsupported geometry type" in response.json()["detail"] or "No features with geometry found" in response.json()["detail"]
 
-def test_convert_mismatched_geometries(mixed_incompatible_geojson):
-    # The test expects a valid zip because the first feature (Point) is processed, and the second (Polygon) is skipped.
-    geojson_content = json.dumps(mixed_incompatible_geojson).encode('utf-8')
+def test_convert_gpkg_invalid_coordinates(client):
+    features = [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [i, i]}, "properties": {"id": i}}
+        for i in range(4)
+    ]
+    features[2]["geometry"]["coordinates"] = ["a", "b"]
+    geojson_content = json.dumps({"type": "FeatureCollection", "features": features}).encode('utf-8')
+    response = client.post(
+        "/convert",
+        files={"file": ("bad.json", geojson_content, "application/json")},
+        data={"name": "bad_coords", "format": "gpkg"}
+    )
+    # A failed write would leave an unreadable GeoPackage, so the request fails instead
+    assert response.status_code == 400
+    assert "Invalid feature for GPKG output" in response.json()["detail"]
+
+def test_convert_shp_empty_parts(client):
+    features = [
+        # All rings empty: nothing to write, so the feature is skipped
+        {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [[]]}, "properties": {"id": 1}},
+        # The empty hole is dropped and the exterior kept
+        {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]], []]},
+         "properties": {"id": 2}},
+    ]
+    geojson_content = json.dumps({"type": "FeatureCollection", "features": features}).encode('utf-8')
     response = client.post(
         "/convert",
-        files={"file": ("mismatched.json", geojson_content, "application/json")},
-        data={"name": "mismatched", "format": "shp"}
+        files={"file": ("empty_parts.json", geojson_content, "application/json")},
+        data={"name": "empty_parts", "format": "shp"}
     )
     assert response.status_code == 200
-    assert response.headers["content-type"] == "application/zip"
-    
-    zip_buffer = io.BytesIO(response.content)
-    with zipfile.ZipFile(zip_buffer, 'r') as zf:
-        # We expect a valid shapefile for the points, as polygons will be skipped.
-        assert set(zf.namelist()) == {'mismatched.shp', 'mismatched.shx', 'mismatched.dbf', 'mismatched.prj'} 
\ No newline at end of file
+    with zipfile.ZipFile(io.BytesIO(response.content), 'r') as zf:
+        reader = shapefile.Reader(shp=io.BytesIO(zf.read("empty_parts.shp")),
+                                  shx=io.BytesIO(zf.read("empty_parts.shx")),
+                                  dbf=io.BytesIO(zf.read("empty_parts.dbf")))
+        assert [r["id"] for r in reader.records()] == [2]
+        assert list(reader.shape(0).parts) == [0]
+
+    # An empty position cannot be packed at all
+    geojson_content = json.dumps({
+        "type": "FeatureCollection",
+        "features": [{"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[]]}, "properties": {"id": 1}}]
+    }).encode('utf-8')
+    response = client.post(
+        "/convert",
+        files={"file": ("empty_position.json", geojson_content, "application/json")},
+        data={"name": "empty_position", "format": "shp"}
+    )
+    assert response.status_code == 400
+    assert "Invalid feature for SHP output" in response.json()["detail"]
+
+def test_convert_polygon_with_hole_geometry(client):
+    geojson = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    # Counter-clockwise exterior, clockwise hole (GeoJSON winding)
+                    "coordinates": [
+                        [[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]],
+                        [[1, 1], [1, 2], [2, 2], [2, 1], [1, 1]],
+                    ],
+                },
+                "properties": {"id": 1},
+            },
+            {
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [[[5, 5], [6, 5], [6, 7], [5, 5]]]},
+                "properties": {"id": 2},
+            },
+        ],
+    }
+    response = client.post(
+        "/convert",
+        files={"file": ("holes.json", json.dumps(geojson).encode('utf-8'), "application/json")},
+        data={"name": "test_holes", "format": "shp"}
+    )
+    assert response.status_code == 200
+
+    with zipfile.ZipFile(io.BytesIO(response.content), 'r') as zf:
+        reader = shapefile.Reader(shp=io.BytesIO(zf.read("test_holes.shp")),
+                                  shx=io.BytesIO(zf.read("test_holes.shx")),
+                                  dbf=io.BytesIO(zf.read("test_holes.dbf")))
+        assert reader.shapeType == shapefile.POLYGON
+        assert list(reader.bbox) == [0, 0, 6, 7]
+        assert len(reader) == 2
+
+        shape = reader.shape(0)
+        assert list(shape.parts) == [0, 5]
+        exterior, hole = shape.points[:5], shape.points[5:]
+        # Shapefile winding: clockwise exterior, counter-clockwise hole
+        assert shapefile.is_cw(exterior)
+        assert not shapefile.is_cw(hole)
+        assert list(reader.shape(1).bbox) == [5, 5, 6, 7]
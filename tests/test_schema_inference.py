@@ -1,15 +1,9 @@
-from fastapi.testclient import TestClient
-from main import app
 import zipfile
 import io
 import shapefile
-import shutil
 import json
-import os
 
-client = TestClient(app)
-
-def test_schema_inference_heterogeneous_features():
+def test_schema_inference_heterogeneous_features(client):
     """
     Test that the converter correctly infers schema from ALL features,
     not just the first one.
@@ -44,30 +38,26 @@ def test_schema_inference_heterogeneous_features():
     assert response.status_code == 200
     
     # Verify Shapefile content
-    zip_content = io.BytesIO(response.content)
-    try:
-        with zipfile.ZipFile(zip_content) as zf:
-            # Extract to a temp dir to read with pyshp
-            zf.extractall("temp_test_shp")
-            
-            sf = shapefile.Reader("temp_test_shp/test_schema.shp")
-            fields = [f[0] for f in sf.fields][1:] # Skip DeletionFlag
-            
-            # Check if both fields exist
-            assert "only_in_fi" in fields or "only_in_first" in fields # truncated
-            assert "only_in_se" in fields or "only_in_second" in fields # truncated
-            
-            records = sf.records()
-            assert len(records) == 2
-            # Check values
-            assert len(records[0]) >= 3 # id, only_in_first, only_in_second
-            
-            sf.close()
-    finally:
-        if os.path.exists("temp_test_shp"):
-            shutil.rmtree("temp_test_shp")
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        sf = shapefile.Reader(
+            shp=io.BytesIO(zf.read("test_schema.shp")),
+            shx=io.BytesIO(zf.read("test_schema.shx")),
+            dbf=io.BytesIO(zf.read("test_schema.dbf")),
+        )
+        fields = [f[0] for f in sf.fields][1:] # Skip DeletionFlag
+        
+        # Check if both fields exist
+        assert "only_in_fi" in fields or "only_in_first" in fields # truncated
+        assert "only_in_se" in fields or "only_in_second" in fields # truncated
+        
+        records = sf.records()
+        assert len(records) == 2
+        # Check values
+        assert len(records[0]) >= 3 # id, only_in_first, only_in_second
+        
+        sf.close()
 
-def test_schema_inference_type_promotion():
+def test_schema_inference_type_promotion(client):
     """
     Test that types are promoted correctly (int -> float -> str).
     """
@@ -108,21 +98,116 @@ def test_schema_inference_type_promotion():
     )
     assert response.status_code == 200
     
-    zip_content = io.BytesIO(response.content)
-    try:
-        with zipfile.ZipFile(zip_content) as zf:
-            zf.extractall("temp_test_types")
-            sf = shapefile.Reader("temp_test_types/test_types.shp")
-            
-            # Check field types
-            # Field structure: (name, type, size, decimal)
-            # Type 'N' = number (int/float), 'C' = character (string)
-            fields_dict = {f[0]: f[1] for f in sf.fields[1:]}
-            
-            assert fields_dict.get('mixed_num') == 'N' or fields_dict.get('mixed_num') == 'F'
-            assert fields_dict.get('mixed_str') == 'C'
-            
-            sf.close()
-    finally:
-        if os.path.exists("temp_test_types"):
-            shutil.rmtree("temp_test_types")
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        sf = shapefile.Reader(
+            shp=io.BytesIO(zf.read("test_types.shp")),
+            shx=io.BytesIO(zf.read("test_types.shx")),
+            dbf=io.BytesIO(zf.read("test_types.dbf")),
+        )
+        
+        # Check field types
+        # Field structure: (name, type, size, decimal)
+        # Type 'N' = number (int/float), 'C' = character (string)
+        fields_dict = {f[0]: f[1] for f in sf.fields[1:]}
+        
+        assert fields_dict.get('mixed_num') == 'N' or fields_dict.get('mixed_num') == 'F'
+        assert fields_dict.get('mixed_str') == 'C'
+        
+        sf.close()
+
+def test_schema_inference_text_field_width(client):
+    """
+    Test that text fields are sized to the widest value instead of 254.
+    """
+    geojson = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [0, 0]},
+                "properties": {"label": "abc", "mixed": 7}
+            },
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [1, 1]},
+                "properties": {"label": "çğışöü", "mixed": "x"} # 12 bytes in UTF-8
+            },
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [2, 2]},
+                "properties": {"label": None, "mixed": 123456}
+            }
+        ]
+    }
+
+    geojson_content = json.dumps(geojson).encode('utf-8')
+
+    response = client.post("/convert", 
+        files={"file": ("test.json", geojson_content, "application/json")},
+        data={
+            "name": "test_widths",
+            "format": "shp"
+        }
+    )
+    assert response.status_code == 200
+    
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        sf = shapefile.Reader(
+            shp=io.BytesIO(zf.read("test_widths.shp")),
+            shx=io.BytesIO(zf.read("test_widths.shx")),
+            dbf=io.BytesIO(zf.read("test_widths.dbf")),
+        )
+        
+        # Field structure: (name, type, size, decimal)
+        fields_dict = {f[0]: (f[1], f[2]) for f in sf.fields[1:]}
+        
+        assert fields_dict.get('label') == ('C', 12)
+        # Promoted to text: sized by the longest stringified number
+        assert fields_dict.get('mixed') == ('C', 6)
+        assert sf.record(1)['label'] == "çğışöü"
+        
+        sf.close()
+
+def test_schema_inference_field_name_deduplication(client):
+    """
+    Test that keys sharing a 10-char prefix get unique numbered field names.
+    """
+    geojson = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [0, 0]},
+                "properties": {
+                    "population_2010": 1,
+                    "population_2020": 2,
+                    "population_2030": 3,
+                    "populatio1": 4
+                }
+            }
+        ]
+    }
+
+    geojson_content = json.dumps(geojson).encode('utf-8')
+
+    response = client.post("/convert", 
+        files={"file": ("test.json", geojson_content, "application/json")},
+        data={
+            "name": "test_dedup",
+            "format": "shp"
+        }
+    )
+    assert response.status_code == 200
+    
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        sf = shapefile.Reader(
+            shp=io.BytesIO(zf.read("test_dedup.shp")),
+            shx=io.BytesIO(zf.read("test_dedup.shx")),
+            dbf=io.BytesIO(zf.read("test_dedup.dbf")),
+        )
+        
+        fields = [f[0] for f in sf.fields[1:]]
+        assert fields == ['population', 'populatio1', 'populatio2', 'populatio3']
+        assert list(sf.record(0)) == [1, 2, 3, 4]
+        
+        sf.close()